@@ -0,0 +1,63 @@
+import argparse
+import time
+
+from mnk_game.board import MnkBoard
+
+
+# (name, stones of the player to move, opponent stones, expected forced win
+# or None if unknown), on a 15x15 board with k=5
+POSITIONS = [
+    ("five in one", [(5, 5), (6, 5), (7, 5), (8, 5)],
+        [(5, 6), (6, 6), (7, 6)], True),
+    ("open three", [(6, 7), (7, 7), (8, 7)], [(0, 0), (14, 14)], True),
+    ("diagonal four", [(3, 3), (4, 4), (5, 5), (6, 6)], [(2, 2)], True),
+    ("anti-diagonal four", [(3, 9), (4, 8), (5, 7), (6, 6)], [(7, 5)], True),
+    ("double three", [(5, 7), (6, 7), (7, 5), (7, 6)], [(0, 0), (14, 14)], True),
+    ("double three, center taken", [(5, 7), (6, 7), (7, 5), (7, 6)],
+        [(7, 7), (14, 14)], None),
+    ("opponent four", [(6, 10), (7, 10), (8, 10), (2, 3)],
+        [(3, 3), (4, 3), (5, 3), (6, 3)], False),
+    ("lone stone", [(7, 7)], [(8, 8)], False),
+]
+
+
+def make_board(own, other, m=15, n=15, k=5):
+    board = MnkBoard(m, n, k)
+    for pos in own:
+        board.put(1, pos, False)
+    for pos in other:
+        board.put(2, pos, False)
+    return board
+
+
+def main(opt):
+    total_time = 0
+    for name, own, other, expected in POSITIONS:
+        board = make_board(own, other)
+        start = time.time()
+        move, nodes = board.threat_search(1, opt.depth, opt.nodes)
+        latency = time.time() - start
+        total_time += latency
+        found = move is not None
+        status = "-" if expected is None else ("OK" if found == expected else "FAILED")
+        print("%-28s %-6s move: %-10s nodes: %6i time: %8.2fms" %
+            (name, status, move, nodes, latency * 1000))
+        threat, _ = board.threat_search(2, opt.depth, opt.nodes)
+        if threat is not None:
+            print("%-28s opponent threat %s, defences: %s" %
+                ("", threat, board.threat_defences(2, threat)))
+    print("Total time: %.2fms" % (total_time * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth',
+                        type=int,
+                        default=8,
+                        help='maximum number of threats')
+    parser.add_argument('--nodes',
+                        type=int,
+                        default=2000,
+                        help='node budget of each search')
+    opt = parser.parse_args()
+    main(opt)
@@ -1,4 +1,5 @@
 # cython: infer_types=True
+import time
 import numpy as np
 cimport numpy as np
 cimport cython
@@ -44,11 +45,203 @@ cdef bint check_board_cdef(bb, n, k):
     return False
 
 
+cdef inline tuple transform_coor(int i, int j, int m, int n, int t):
+    # 0: identity, 1: flip x, 2: flip y, 3: rotate 180,
+    # 4-7 (square boards only): transpose, rotate 90, rotate 270, anti-transpose
+    if t == 0:
+        return i, j
+    elif t == 1:
+        return m-1-i, j
+    elif t == 2:
+        return i, n-1-j
+    elif t == 3:
+        return m-1-i, n-1-j
+    elif t == 4:
+        return j, i
+    elif t == 5:
+        return n-1-j, i
+    elif t == 6:
+        return j, m-1-i
+    else:
+        return n-1-j, m-1-i
+
+
+cdef transform_bitboard_cdef(bb, int m, int n, int t):
+    cdef int i, j
+    cdef mpz res = mpz(0)
+    if t == 0:
+        return bb
+    # only visits set bits, so cost grows with the number of stones
+    idx = bb.bit_scan1(0)
+    while idx is not None:
+        i = idx // (n+1)
+        j = n - 1 - idx % (n+1)
+        i, j = transform_coor(i, j, m, n, t)
+        res += mpz(1) << (n - 1 - j + i*(n+1))
+        idx = bb.bit_scan1(idx+1)
+    return res
+
+
+cdef board_mask(int m, int n):
+    # all cells of the board, without the separator bit of each column
+    cdef int i
+    cdef mpz res = mpz(0)
+    for i in range(m):
+        res |= ((mpz(1) << n) - 1) << (i*(n+1))
+    return res
+
+
+cdef line_cells(bb, empty, int n, int k, int gaps):
+    # empty cells c lying on a k-cell line which holds only bb stones apart
+    # from c and `gaps` other empty cells. gaps=0 gives winning cells, gaps=1
+    # moves making a four, gaps=2 moves making a three
+    cdef int s, t, i, target = k - 1 - gaps
+    cdef list counter
+    res = mpz(0)
+    free = bb | empty
+    for s in (1, n+1, n, n+2):
+        # lines are indexed by their first cell, they must not hold any
+        # opponent stone
+        lines = free
+        for t in range(1, k):
+            lines &= free >> (t*s)
+        # bit-sliced counter of bb stones on each line
+        counter = []
+        for t in range(k):
+            carry = (bb >> (t*s)) & lines
+            for i in range(len(counter)):
+                if not carry:
+                    break
+                counter[i], carry = counter[i] ^ carry, counter[i] & carry
+            if carry:
+                counter.append(carry)
+        if target >> len(counter):
+            continue
+        for i in range(len(counter)):
+            lines &= counter[i] if (target >> i) & 1 else ~counter[i]
+        if not lines:
+            continue
+        for t in range(k):
+            res |= (lines << (t*s)) & empty
+    return res
+
+
+cdef critical_cells(att, empty, int n, int k):
+    # moves making an open four (two winning cells) and their winning cells,
+    # the defender has to play one of them against a three
+    res = mpz(0)
+    fours = line_cells(att, empty, n, k, 1)
+    idx = fours.bit_scan1(0)
+    while idx is not None:
+        bit = mpz(1) << idx
+        wins = line_cells(att | bit, empty ^ bit, n, k, 0)
+        if wins & (wins - 1):
+            res |= bit | wins
+        idx = fours.bit_scan1(idx+1)
+    return res
+
+
+cdef class ThreatSearcher:
+    # threat-space search for a forced win by continuous fours (VCF) or, with
+    # vct, fours and threes (VCT). Nodes are searched until max_nodes or, if
+    # set, until the deadline (a time.time() value)
+    cdef:
+        int m
+        int n
+        int k
+        int max_nodes
+        double deadline
+        bint vct
+        public int nodes
+        public bint exhausted
+        object full
+        dict cache
+
+    def __init__(self, int m, int n, int k, int max_nodes, bint vct=True,
+            dict cache=None, double deadline=0):
+        self.m = m
+        self.n = n
+        self.k = k
+        self.max_nodes = max_nodes
+        self.deadline = deadline
+        self.vct = vct
+        self.nodes = 0
+        self.exhausted = False
+        self.full = board_mask(m, n)
+        # results by position, can be shared between searches
+        self.cache = cache if cache is not None else {}
+
+    cpdef int attack(self, att, dfn, int depth):
+        # att is to move, returns the bit index of the first move of a forced
+        # win for att or -1 if none is found
+        cdef int res
+        empty = self.full & ~(att | dfn)
+        wins = line_cells(att, empty, self.n, self.k, 0)
+        if wins:
+            return wins.bit_scan1(0)
+        if depth <= 0:
+            return -1
+        key = (self.m, self.n, self.k, att, dfn, depth, self.vct)
+        if key in self.cache:
+            return self.cache[key]
+        if self.nodes >= self.max_nodes or \
+                (self.deadline and time.time() > self.deadline):
+            self.exhausted = True
+            return -1
+        self.nodes += 1
+        res = self.attack_moves(att, dfn, empty, depth)
+        # results found after running out of nodes may be incomplete
+        if res != -1 or not self.exhausted:
+            self.cache[key] = res
+        return res
+
+    cdef int attack_moves(self, att, dfn, empty, int depth):
+        cdef bint refuted
+        threats = line_cells(dfn, empty, self.n, self.k, 0)
+        if threats & (threats - 1):
+            return -1  # two winning cells of the defender cannot be blocked
+        fours = line_cells(att, empty, self.n, self.k, 1)
+        if threats:
+            fours &= threats  # att has to block with a four
+        idx = fours.bit_scan1(0)
+        while idx is not None:
+            bit = mpz(1) << idx
+            wins = line_cells(att | bit, empty ^ bit, self.n, self.k, 0)
+            if wins & (wins - 1):
+                return idx
+            # the only defence is to block the winning cell
+            if self.attack(att | bit, dfn | wins, depth-1) != -1:
+                return idx
+            idx = fours.bit_scan1(idx+1)
+        if not self.vct or threats:
+            return -1
+        threes = line_cells(att, empty, self.n, self.k, 2) & ~fours
+        idx = threes.bit_scan1(0)
+        while idx is not None:
+            bit = mpz(1) << idx
+            defences = critical_cells(att | bit, empty ^ bit, self.n, self.k)
+            if defences:
+                # the defender may also answer with a four of its own
+                defences |= line_cells(dfn, empty ^ bit, self.n, self.k, 1)
+                refuted = False
+                defence = defences.bit_scan1(0)
+                while defence is not None:
+                    if self.attack(att | bit, dfn | (mpz(1) << defence),
+                            depth-1) == -1:
+                        refuted = True
+                        break
+                    defence = defences.bit_scan1(defence+1)
+                if not refuted:
+                    return idx
+            idx = threes.bit_scan1(idx+1)
+        return -1
+
+
 cdef class MnkBoard:
     cdef:
         public int m
         public int n
-        int k
+        public int k
         list board
 
     def __init__(self, int m, int n, int k, board_copy=None):
@@ -131,3 +324,137 @@ cdef class MnkBoard:
                     bitmask += mpz(1) << (self.n - 1 - pos[1] - j + (pos[0]+i) * (self.n+1))
         return (self.board[0] & bitmask) or (self.board[1] & bitmask)
 
+    def cells(self):
+        # array indexed by bit index with 0 for empty cells and column
+        # separators, 1 and 2 for player symbols
+        cdef int nbytes = (self.m * (self.n+1) + 7) // 8
+        bits = np.unpackbits(np.frombuffer(
+            int(self.board[0]).to_bytes(nbytes, "little") +
+            int(self.board[1]).to_bytes(nbytes, "little"), dtype=DTYPE
+        ), bitorder="little").reshape(2, nbytes*8)
+        return bits[0] + 2*bits[1]
+
+    def line_windows(self):
+        # bit indices of the cells of every k-cell line, found by their first
+        # cell like in line_cells
+        cdef int s, t, k = self.k, n = self.n
+        cdef list res = []
+        full = board_mask(self.m, n)
+        for s in (1, n+1, n, n+2):
+            lines = full
+            for t in range(1, k):
+                lines &= full >> (t*s)
+            idx = lines.bit_scan1(0)
+            while idx is not None:
+                res.append([idx + t*s for t in range(k)])
+                idx = lines.bit_scan1(idx+1)
+        return np.array(res, dtype=np.intp).reshape(-1, k)
+
+    def bit_to_pos(self, int idx):
+        return idx // (self.n+1), self.n - 1 - idx % (self.n+1)
+
+    def threat_search(self, int turn, int max_depth, int max_nodes, bint vct=True,
+            dict cache=None, double deadline=0):
+        # looks for a forced win of turn, as if turn was to move: by continuous
+        # fours (VCF) first, then with threes as well (VCT), deepening up to
+        # max_depth threats. Returns (first move or None, searched nodes)
+        cdef int depth, idx = -1, nodes = 0
+        modes = [False, True] if vct else [False]
+        for use_vct in modes:
+            searcher = ThreatSearcher(self.m, self.n, self.k, max_nodes - nodes,
+                use_vct, cache, deadline)
+            for depth in range(1, max_depth+1):
+                idx = searcher.attack(self.board[turn-1], self.board[2-turn], depth)
+                if idx != -1 or searcher.exhausted:
+                    break
+            nodes += searcher.nodes
+            if idx != -1:
+                break
+        return (self.bit_to_pos(idx) if idx != -1 else None), nodes
+
+    def threat_defences(self, int turn, move):
+        # candidate defences against a threat of turn starting at move: the
+        # move itself, the cells it makes critical and the opponent's fours
+        att, dfn = self.board[turn-1], self.board[2-turn]
+        empty = board_mask(self.m, self.n) & ~(att | dfn)
+        bit = mpz(1) << (self.n - 1 - move[1] + move[0]*(self.n+1))
+        cells = bit | line_cells(att | bit, empty ^ bit, self.n, self.k, 0) | \
+            critical_cells(att | bit, empty ^ bit, self.n, self.k) | \
+            line_cells(dfn, empty, self.n, self.k, 1)
+        # move may already win, then the other winning cells have to be blocked
+        cells |= line_cells(att, empty, self.n, self.k, 0)
+        res = []
+        idx = cells.bit_scan1(0)
+        while idx is not None:
+            res.append(self.bit_to_pos(idx))
+            idx = cells.bit_scan1(idx+1)
+        return res
+
+    def num_symmetries(self):
+        # square boards have 8 dihedral symmetries, rectangular ones have 4
+        return 8 if self.m == self.n else 4
+
+    def transform_pos(self, pos, int t):
+        return transform_coor(pos[0], pos[1], self.m, self.n, t)
+
+    def transform_bitboard(self, bb, int t):
+        return transform_bitboard_cdef(bb, self.m, self.n, t)
+
+    def transform(self, int t):
+        return MnkBoard(self.m, self.n, self.k, [
+            transform_bitboard_cdef(self.board[0], self.m, self.n, t),
+            transform_bitboard_cdef(self.board[1], self.m, self.n, t),
+        ])
+
+    cpdef bint equals(self, MnkBoard other):
+        return self.m == other.m and self.n == other.n and \
+            self.board[0] == other.board[0] and self.board[1] == other.board[1]
+
+    def symmetries(self):
+        # symmetries which leave the position unchanged (always includes 0)
+        cdef int t
+        cdef list res = [0]
+        for t in range(1, self.num_symmetries()):
+            if transform_bitboard_cdef(self.board[0], self.m, self.n, t) == self.board[0] and \
+                    transform_bitboard_cdef(self.board[1], self.m, self.n, t) == self.board[1]:
+                res.append(t)
+        return res
+
+    def unique_pos(self, list pos, list syms):
+        # keeps one representative (the smallest) of each group of positions
+        # that are symmetric equivalents under syms
+        cdef int t
+        cdef list res = []
+        for p in pos:
+            for t in syms:
+                if transform_coor(p[0], p[1], self.m, self.n, t) < p:
+                    break
+            else:
+                res.append(p)
+        return res
+
+    def canonical_form(self):
+        # returns the smallest transformed bitboards and the symmetry used
+        cdef int t, best_t = 0
+        best = (self.board[0], self.board[1])
+        for t in range(1, self.num_symmetries()):
+            cand = (transform_bitboard_cdef(self.board[0], self.m, self.n, t),
+                    transform_bitboard_cdef(self.board[1], self.m, self.n, t))
+            if cand < best:
+                best, best_t = cand, t
+        return best, best_t
+
+    def canonical_hash(self):
+        return hash((self.m, self.n, self.k) + self.canonical_form()[0])
+
+    def find_transform(self, MnkBoard other):
+        # returns t such that self.transform(t) equals other, -1 if none
+        cdef int t
+        if self.m != other.m or self.n != other.n:
+            return -1
+        for t in range(self.num_symmetries()):
+            if transform_bitboard_cdef(self.board[0], self.m, self.n, t) == other.board[0] and \
+                    transform_bitboard_cdef(self.board[1], self.m, self.n, t) == other.board[1]:
+                return t
+        return -1
+
@@ -1,6 +1,7 @@
 import sys
 import os
 import random
+import threading
 from typing import Tuple
 
 os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
@@ -64,9 +65,26 @@ class Game:
         pygame.display.set_caption(self.title)
         self.cursor = pygame.SYSTEM_CURSOR_ARROW
         self.rect_cache = {}
+        self.font_cache = {}
+        self.text_cache = {}
+        # only rects drawn in the current frame are pushed to the display
+        self.dirty_rects = []
+        self.dirty_cells = set()
+        self.full_redraw = True
+        self.status_text = None
+        self.menu_rects = None
+        self.button_rects = None
         self.bot = None
         self.bot_config = None
         self.moves = []
+        # bot searches in a background thread so the event loop keeps running
+        self.bot_thread = None
+        self.bot_stop = threading.Event()
+        self.bot_result = None
+        self.bot_progress = None
+        self.last_tree = None
+        self.last_move = None
+        self.current_winrate = None
 
     def set_bot(self, name: str):
         self.bot = name
@@ -74,15 +92,20 @@ class Game:
     def add_bot_config(self, cfg):
         self.bot_config = cfg
 
-    def bot_play(self) -> None:
+    def bot_think(self, board, last_moves, callback=None):
         tree = None
         if self.bot is None:
-            pos = self.board.get_possible_pos()
+            pos = board.get_possible_pos()
             index = random.randrange(0, len(pos))
             i, j = pos[index]
         elif self.bot == "mcts":
             res, tree = mcts_solve(
-                **self.bot_config, board=self.board, turn=1, last_moves=self.moves[-2:]
+                **self.bot_config,
+                board=board,
+                turn=1,
+                last_moves=last_moves,
+                callback=callback,
+                stop=self.bot_stop,
             )
             if res == (-1, -1):
                 raise Exception("MCTS doesn't yield result!")
@@ -90,10 +113,51 @@ class Game:
                 i, j = res
         else:
             raise NotImplementedError("%s algorithm is not implemented!" % self.bot)
-        self.board.put(2, (i, j))
-        self.moves.append((i, j))
         return tree, (i, j)
 
+    def bot_worker(self, board, last_moves):
+        try:
+            self.bot_result = self.bot_think(board, last_moves, self.on_bot_progress)
+        except Exception as e:
+            self.bot_result = e
+
+    def on_bot_progress(self, snapshot):
+        # called from the search thread, returning True stops the search
+        self.bot_progress = snapshot
+        return self.bot_stop.is_set()
+
+    def start_bot(self):
+        self.bot_stop.clear()
+        self.bot_result = None
+        self.bot_progress = None
+        self.bot_thread = threading.Thread(
+            target=self.bot_worker,
+            args=(self.board.duplicate(), self.moves[-2:]),
+            daemon=True,
+        )
+        self.bot_thread.start()
+
+    def stop_bot(self):
+        # the result of a stopped search is discarded
+        if self.bot_thread is not None:
+            self.bot_stop.set()
+
+    def poll_bot(self):
+        # returns (tree, move) once the search has finished, None otherwise
+        if self.bot_thread is not None and self.bot_stop.is_set():
+            if self.bot_thread.is_alive():
+                return None  # waits for the stopped search to exit
+            self.bot_thread = None
+        if self.bot_thread is None:
+            self.start_bot()
+            return None
+        if self.bot_thread.is_alive():
+            return None
+        self.bot_thread = None
+        if isinstance(self.bot_result, Exception):
+            raise self.bot_result
+        return self.bot_result
+
     def add_rect_to_cache(
         self, rect: Rect, left: int, top: int, width: int, height: int
     ):
@@ -106,6 +170,22 @@ class Game:
     def clear_rect_cache(self):
         self.rect_cache = {}
 
+    def get_font(self, size: int) -> Font:
+        font = self.font_cache.get(size, None)
+        if font is None:
+            font = Font(None, size)
+            self.font_cache[size] = font
+        return font
+
+    def get_text(self, text_str, size, color, cache=True):
+        key = (text_str, size, color)
+        text = self.text_cache.get(key, None)
+        if text is None:
+            text = self.get_font(size).render(text_str, True, color)
+            if cache:
+                self.text_cache[key] = text
+        return text
+
     def render_rect(
         self,
         position,
@@ -119,6 +199,7 @@ class Game:
         text_str=None,
         text_size=25,
         text_color=constants.BLACK,
+        cache_text=True,
     ):
         left, top, width, height = position
         rect = self.get_rect_from_cache(left, top, width, height)
@@ -137,34 +218,46 @@ class Game:
             border_bottom_right_radius,
         )
         if text_str:
-            font = Font(None, text_size)
-            text = font.render(text_str, True, text_color)
+            text = self.get_text(text_str, text_size, text_color, cache_text)
             text_rect = text.get_rect(center=(left + width // 2, top + height // 2))
             self.window.blit(text, text_rect)
+        self.dirty_rects.append(rect)
         return rect
 
+    def render_cell(self, x, y):
+        position = (
+            x * self.cell_size,
+            y * self.cell_size,
+            self.cell_size,
+            self.cell_size,
+        )
+        symbol = self.board.index(x, y)
+        self.render_rect(position, constants.PAPER_WHITE_COLOR, rect_width=0)
+        self.render_rect(
+            position,
+            constants.PENCIL_COLOR,
+            rect_width=1,
+            text_str=self.turn_symbols[symbol],
+            text_size=self.symbol_font_size,
+            text_color=self.turn_colors[symbol],
+        )
+
     def render_board(self):
-        rects = []
-        for i in range(self.n):
-            rects.append([])
-            for j in range(self.m):
-                symbol = self.board.index(j, i)
-                rects[i].append(
-                    self.render_rect(
-                        (
-                            j * self.cell_size,
-                            i * self.cell_size,
-                            self.cell_size,
-                            self.cell_size,
-                        ),
-                        constants.PENCIL_COLOR,
-                        rect_width=1,
-                        text_str=self.turn_symbols[symbol],
-                        text_size=self.symbol_font_size,
-                        text_color=self.turn_colors[symbol],
-                    )
-                )
-        return rects
+        for y in range(self.n):
+            for x in range(self.m):
+                self.render_cell(x, y)
+        self.dirty_cells.clear()
+
+    def render_dirty_cells(self):
+        for x, y in self.dirty_cells:
+            self.render_cell(x, y)
+        self.dirty_cells.clear()
+
+    def get_cell(self, pos):
+        x, y = pos
+        if 0 <= x < self.m * self.cell_size and 0 <= y < self.n * self.cell_size:
+            return x // self.cell_size, y // self.cell_size
+        return None
 
     def render_start_screen(self) -> Tuple[Rect, Rect]:
         return self.render_rect(
@@ -225,18 +318,24 @@ class Game:
         )
 
     def render_ingame_bottom_text(self, text, text_color):
+        position = (
+            self.w // 4,
+            self.n * self.cell_size,
+            self.w // 2,
+            self.n * self.cell_size // 7,
+        )
+        if self.status_text == (text, text_color):
+            return
+        self.status_text = (text, text_color)
+        self.render_rect(position, constants.PAPER_WHITE_COLOR, rect_width=0)
         self.render_rect(
-            (
-                self.w // 4,
-                self.n * self.cell_size,
-                self.w // 2,
-                self.n * self.cell_size // 7,
-            ),
+            position,
             constants.WHITE,
             rect_width=-1,
             text_str=text,
             text_size=self.button_font_size,
             text_color=text_color,
+            cache_text=False,
         )
 
     def render_endgame_noti(self, res):
@@ -247,16 +346,64 @@ class Game:
             else (constants.RED if res == 2 else constants.BLACK)
         )
         self.render_ingame_bottom_text("%s won!" % who_won, text_color)
-        
+
+    def render_thinking(self):
+        status_text = "Thinking..."
+        if self.bot_progress is not None:
+            status_text = "Thinking: %i rollouts" % self.bot_progress.rollout_count
+            if self.bot_progress.top_moves:
+                status_text += ", best (%i, %i)" % self.bot_progress.top_moves[0][0]
+        elif self.current_winrate is not None:
+            status_text = "Winrate: %.2f%%. " % self.current_winrate + status_text
+        self.render_ingame_bottom_text(status_text, constants.BLACK)
+
+    def reset_game(self):
+        self.stop_bot()
+        self.board.reset_board()
+        self.moves = []
+        self.last_tree = None
+        self.current_winrate = None
+        self.full_redraw = True
+
+    def update_state(self, next_state):
+        res = self.board.check_endgame()
+        if res or len(self.moves) == self.m * self.n:
+            self.state = Game.ENDED
+        else:
+            self.state = next_state
+        return res
+
+    def update_player_winrate(self):
+        # winrate of the player's last move, seen from the previous tree
+        self.current_winrate = None
+        if self.last_tree is None or len(self.moves) < 2 or \
+                self.moves[-2] != self.last_move:
+            return
+        bot_move = self.last_tree.root.children.get(self.last_move, None)
+        if bot_move is None:
+            return
+        this_move = self.last_tree.find_child(bot_move, self.moves[-1])
+        if this_move is not None and this_move.n != 0:
+            self.current_winrate = this_move.score() * 100
+
+    def update_bot_winrate(self):
+        self.current_winrate = None
+        if self.last_tree is not None:
+            winrate = self.last_tree.get_move_winrate(self.last_move)
+            if winrate is not None:
+                self.current_winrate = (1 - winrate) * 100
+
     def main(self):
         res = 0
-        last_tree = None
-        current_winrate = None
         while True:
             pygame.mouse.set_cursor(self.cursor)
-            self.window.fill(constants.PAPER_WHITE_COLOR)
+            full_redraw, self.full_redraw = self.full_redraw, False
+            if full_redraw:
+                self.window.fill(constants.PAPER_WHITE_COLOR)
             if self.state == Game.NOT_STARTED:
-                you_rect, bot_rect = self.render_start_screen()
+                if full_redraw:
+                    self.menu_rects = self.render_start_screen()
+                you_rect, bot_rect = self.menu_rects
 
                 for event in pygame.event.get():
                     if event.type == pygame.QUIT:
@@ -276,22 +423,25 @@ class Game:
                             self.state = Game.PLAYER_TURN
                             self.cursor = pygame.SYSTEM_CURSOR_HAND
                             self.clear_rect_cache()
+                            self.full_redraw = True
                         elif bot_rect.collidepoint(event.pos):
                             self.state = Game.BOT_TURN
                             self.cursor = pygame.SYSTEM_CURSOR_HAND
                             self.clear_rect_cache()
+                            self.full_redraw = True
             else:
-                if self.state != Game.ENDED:
-                    if len(self.board.get_possible_pos()) == 0:
-                        self.state = Game.ENDED
-                        res = 0
-                rects = self.render_board()
-                back_rect, reset_rect = self.render_ingame_button()
-                pygame.display.update()
+                if full_redraw:
+                    self.status_text = None
+                    self.render_board()
+                    self.button_rects = self.render_ingame_button()
+                else:
+                    self.render_dirty_cells()
+                back_rect, reset_rect = self.button_rects
                 try:
                     remaining_events = []
                     for event in pygame.event.get():
                         if event.type == pygame.QUIT:
+                            self.stop_bot()
                             pygame.quit()
                             sys.exit()
                         if (
@@ -300,73 +450,48 @@ class Game:
                             if back_rect.collidepoint(event.pos):
                                 self.state = Game.NOT_STARTED
                                 self.clear_rect_cache()
-                                self.board.reset_board()
-                                self.moves = []
+                                self.reset_game()
                                 raise exception.Break
                             elif reset_rect.collidepoint(event.pos):
                                 self.state = random.choice(
                                     (Game.PLAYER_TURN, Game.BOT_TURN)
                                 )
-                                self.board.reset_board()
-                                self.moves = []
+                                self.reset_game()
                                 raise exception.Break
                         remaining_events.append(event)
 
                     if self.state == Game.PLAYER_TURN:
-                        if current_winrate is not None:
-                            status_text = "Winrate: %.2f%%" % current_winrate
-                            self.render_ingame_bottom_text(
-                                status_text, 
-                                constants.BLACK)
+                        if self.current_winrate is not None:
+                            status_text = "Winrate: %.2f%%" % self.current_winrate
+                        else:
+                            status_text = ""
+                        self.render_ingame_bottom_text(status_text, constants.BLACK)
                         for event in remaining_events:
                             if (
                                 event.type == pygame.MOUSEBUTTONUP and event.button == 1
                             ):  # left mouse
-                                for i, row in enumerate(rects):
-                                    for j, rect in enumerate(row):
-                                        if rect.collidepoint(event.pos):
-                                            if self.board.index(j, i) != 0:
-                                                raise exception.Break
-                                            self.board.put(1, (j, i))
-                                            self.moves.append((j, i))
-                                            res = self.board.check_endgame()
-                                            if res:
-                                                self.state = Game.ENDED
-                                            else:
-                                                self.state = Game.BOT_TURN
-                                            raise exception.Break
+                                cell = self.get_cell(event.pos)
+                                if cell is None or self.board.index(*cell) != 0:
+                                    raise exception.Break
+                                self.board.put(1, cell)
+                                self.moves.append(cell)
+                                self.dirty_cells.add(cell)
+                                res = self.update_state(Game.BOT_TURN)
+                                if self.state == Game.BOT_TURN:
+                                    self.update_player_winrate()
+                                raise exception.Break
 
                     elif self.state == Game.BOT_TURN:
-                        if last_tree is not None:
-                            bot_move = last_tree.root.children[last_move]
-                            this_move = bot_move.children.get((j, i), None)
-                            if this_move.n != 0:
-                                current_winrate = this_move.score() * 100
-                            else:
-                                current_winrate = None
-                        else:
-                            current_winrate = None
-                        status_text = "Thinking..."
-                        if current_winrate is not None:
-                            status_text = "Winrate: %.2f%%. " % current_winrate + status_text
-                        self.render_ingame_bottom_text(
-                            status_text, 
-                            constants.BLACK)
-                        pygame.display.update()
-                        last_tree, last_move = self.bot_play()
-                        if last_tree is not None:
-                            winrate = last_tree.get_move_winrate(last_move)
-                            if winrate is not None:
-                                current_winrate = (1 - winrate) * 100
-                            else:
-                                current_winrate = None
-                        else:
-                            current_winrate = None
-                        res = self.board.check_endgame()
-                        if res:
-                            self.state = Game.ENDED
-                        else:
-                            self.state = Game.PLAYER_TURN
+                        result = self.poll_bot()
+                        if result is None:
+                            self.render_thinking()
+                            raise exception.Break
+                        self.last_tree, self.last_move = result
+                        self.board.put(2, self.last_move)
+                        self.moves.append(self.last_move)
+                        self.dirty_cells.add(self.last_move)
+                        self.update_bot_winrate()
+                        res = self.update_state(Game.PLAYER_TURN)
                         raise exception.Break
                     elif self.state == Game.ENDED:
                         self.render_endgame_noti(res)
@@ -376,7 +501,11 @@ class Game:
                         )
                 except exception.Break:
                     pass
-            pygame.display.update()
+            if full_redraw:
+                pygame.display.update()
+            elif self.dirty_rects:
+                pygame.display.update(self.dirty_rects)
+            self.dirty_rects = []
             self.clock.tick(self.fps)
 
 
@@ -16,9 +16,13 @@ cdef class MnkState:
         public int n
         public float r
         public np.ndarray prob 
+        public evaluator
+        public int rollout_depth
+        list syms
 
     def __init__(self, board, int turn, str policy, last_move, 
-            MnkState parent, children=None, int n=0, float r=0.0) -> None:
+            MnkState parent, children=None, int n=0, float r=0.0,
+            evaluator=None, int rollout_depth=0) -> None:
         self.board = board
         self.turn = turn
         self.policy = policy
@@ -27,6 +31,9 @@ cdef class MnkState:
         self.children = children if children else {}
         self.n = n
         self.r = r
+        self.evaluator = evaluator  # rollouts are only cut off with an evaluator
+        self.rollout_depth = rollout_depth
+        self.syms = None  # board symmetries, computed on first expansion
 
     def score(self):
         return self.r / self.n if self.n != 0 else -INFINITY
@@ -41,13 +48,19 @@ cdef class MnkState:
 
     def next_states(self):
         pos = self.board.get_possible_pos()
+        syms = self.symmetries()
+        if len(syms) > 1:
+            # while the position is symmetric, equivalent moves lead to
+            # equivalent subtrees so only one of them is expanded
+            pos = self.board.unique_pos(pos, syms)
         states = []
         for p in pos:
             new_board = self.board.duplicate()
 
             new_board.put(3 - self.turn, p, False)
             new_state = MnkState(new_board, 3-self.turn, self.policy, 
-                p, self)
+                p, self, evaluator=self.evaluator,
+                rollout_depth=self.rollout_depth)
             states.append(new_state)
         return states
 
@@ -61,19 +74,44 @@ cdef class MnkState:
             state.r += other.r
         else:
             state = MnkState(self.board.duplicate(), self.turn, self.policy,
-                self.last_move, parent, self.children, self.n+other.n, self.r+other.r)
+                self.last_move, parent, self.children, self.n+other.n, self.r+other.r,
+                self.evaluator, self.rollout_depth)
         return state
 
+    def symmetries(self):
+        if self.syms is None:
+            self.syms = self.board.symmetries()
+        return self.syms
+
+    def transform(self, int t):
+        # re-orients this subtree in place by board symmetry t
+        cdef dict children = {}
+        if self.last_move is not None:
+            self.last_move = self.board.transform_pos(self.last_move, t)
+        self.board = self.board.transform(t)
+        self.syms = None
+        for child in self.children.values():
+            child.transform(t)
+            children[child.last_move] = child
+        self.children = children
+        return self
+
     def rollout(self):
+        # returns the value of the playout for player 1: 1 for a win, 0 for a
+        # loss and 0.5 for a draw. With an evaluator, playouts are cut off
+        # after rollout_depth plies and scored by it instead
         test_board = self.board.duplicate()
-        cdef int turn = self.turn
+        cdef int turn = 3 - self.turn  # self.turn made the last move
         cdef int res = test_board.check_endgame()
         cdef int i, j, index
+        cdef int depth = 0
         cdef list pos = test_board.get_possible_pos()
         cdef np.ndarray near_symbol
         if self.policy == "prob":
             near_symbol = self.get_near_symbol_list(test_board, pos)
         while res == 0 and len(pos) != 0:
+            if self.evaluator is not None and depth >= self.rollout_depth:
+                return self.evaluator.evaluate(test_board, turn)
             if self.policy == "simple":
                 index = random.randrange(0, len(pos))
                 i, j = pos[index]
@@ -87,8 +125,9 @@ cdef class MnkState:
             pos.pop(index)
             test_board.put(turn, (i, j), False)
             turn = 3-turn
+            depth += 1
             res = test_board.check_endgame(i, j)
-        return res
+        return 1.0 if res == 1 else (0.0 if res == 2 else 0.5)
 
     cdef np.ndarray get_near_symbol_list(self, board, list pos):
         cdef Py_ssize_t i
@@ -1,7 +1,8 @@
 import time
 import random
 import multiprocessing
-from typing import Tuple
+from queue import Empty
+from typing import List, NamedTuple, Tuple
 
 import numpy as np
 
@@ -9,17 +10,41 @@ from mcts.mcts import MonteCarloTreeSearchMixin
 from .mnk_bot_base import MnkGameBotBase
 from .board import MnkBoard
 from .mcts_mnk_algorithms import MnkState
+from .pattern_evaluator import load_evaluator
 
 
 last_tree = None
+threat_cache = {}  # threat-space search results, kept between turns
+THREAT_CACHE_SIZE = 100000
+
+
+class Snapshot(NamedTuple):
+    rollout_count: int  # rollouts played in this search
+    total_rollout: int  # including rollouts inherited from previous trees
+    elapsed: float  # in seconds
+    playouts_per_sec: float
+    top_moves: List[Tuple[Tuple[int, int], int, float]]  # (move, n, winrate)
+    pv: List[Tuple[int, int]]  # principal variation
+
+
+def make_snapshot(stats, pv, rollout_count, total_rollout, elapsed, top_k=5):
+    # stats maps root moves to (n, r)
+    top_moves = [(move, n, r / n) for move, (n, r) in stats.items() if n != 0]
+    top_moves.sort(key=lambda move: -move[2])
+    return Snapshot(rollout_count, total_rollout, elapsed,
+        rollout_count / elapsed if elapsed > 0 else 0.0, top_moves[:top_k], pv)
 
 
 class MonteCarloTreeSearchMnkGame(MonteCarloTreeSearchMixin, MnkGameBotBase):
-    def __init__(self, max_thinking_time, max_rollout, policy, exploration_const) -> None:
+    def __init__(self, max_thinking_time, max_rollout, policy, exploration_const,
+            evaluator=None, rollout_depth=0, root_moves=None) -> None:
         super().__init__(max_thinking_time)
         self.max_rollout = max_rollout
         self.policy = policy
         self.c = exploration_const
+        self.evaluator = evaluator
+        self.rollout_depth = rollout_depth
+        self.root_moves = root_moves  # restricts moves from the root if set
 
     def inherit(self, last_moves: Tuple[Tuple[int, int], Tuple[int, int]]):
         # inherits previous tree root
@@ -27,20 +52,90 @@ class MonteCarloTreeSearchMnkGame(MonteCarloTreeSearchMixin, MnkGameBotBase):
         if self.root is None:
             print("Initializing new tree...")
             return None
-        try:
-            print("Inheriting previous tree root...")
-            new_root = self.root.children[m1].children[m2]
-            return new_root
-        except KeyError:
+        print("Inheriting previous tree root...")
+        node = self.find_child(self.root, m1)
+        new_root = self.find_child(node, m2) if node is not None else None
+        if new_root is None:
             print("Moves not found in previous tree. Initializing new tree...")
             return None
+        new_root.parent = None
+        return new_root
 
-    def solve(self, board: MnkBoard, turn: int, start_time=None) -> Tuple[int, int]:
+    def find_child(self, node, move):
+        # looks a move up through the canonical form, so that a symmetric
+        # equivalent of an expanded move is found as well. The matching
+        # subtree is re-oriented to the actual board
+        if move in node.children:
+            return node.children[move]
+        board = node.board.duplicate()
+        board.put(3-node.turn, move, False)
+        key = board.canonical_hash()
+        for last_move, child in node.children.items():
+            if child.board.canonical_hash() != key:
+                continue
+            t = child.board.find_transform(board)
+            if t == -1:
+                continue
+            child.transform(t)
+            del node.children[last_move]
+            node.children[child.last_move] = child
+            return child
+        return None
+
+    def solve(self, board: MnkBoard, turn: int, start_time=None, callback=None,
+            callback_interval=0.1, callback_rollouts=None, top_k=5) -> Tuple[int, int]:
+        # callback(snapshot) is called every callback_interval seconds or every
+        # callback_rollouts rollouts, the search stops early if it returns True
+        if callback is None:
+            callback_interval = callback_rollouts = None
+        for snapshot in self.analyse(board, turn, start_time, callback_interval,
+                callback_rollouts, top_k):
+            if callback is not None and callback(snapshot):
+                break
+
+    def analyse(self, board: MnkBoard, turn: int, start_time=None, interval=0.1,
+            rollouts=None, top_k=5):
+        # anytime search: yields a Snapshot every interval seconds or every
+        # rollouts rollouts and once more at the end. Stop iterating to stop
+        # the search
         start = start_time if start_time else time.time()
-        self.root = MnkState(board, turn, self.policy, None, None)
+        last_time, last_count = start, self.rollout_count
+        if self.root is None:
+            self.root = MnkState(board, turn, self.policy, None, None,
+                evaluator=self.evaluator, rollout_depth=self.rollout_depth)
+        if self.root_moves is not None:
+            # expansion keeps only the smallest of symmetric equivalent moves
+            syms = self.root.symmetries()
+            self.root_moves = [min(self.root.board.transform_pos(move, t)
+                for t in syms) for move in self.root_moves]
+            self.root.children = {move: child for move, child in
+                self.root.children.items() if move in self.root_moves}
         while time.time()-start < self.max_thinking_time and \
                 self.total_rollout < self.max_rollout:
             self.loop()
+            if (interval is not None and time.time()-last_time >= interval) or \
+                    (rollouts is not None and self.rollout_count-last_count >= rollouts):
+                last_time, last_count = time.time(), self.rollout_count
+                yield self.snapshot(time.time()-start, top_k)
+        yield self.snapshot(time.time()-start, top_k)
+
+    def snapshot(self, elapsed, top_k=5):
+        return make_snapshot(self.root_stats(), self.principal_variation(),
+            self.rollout_count, self.total_rollout, elapsed, top_k)
+
+    def root_stats(self):
+        return {move: (child.n, child.r) for move, child in self.root.children.items()}
+
+    def principal_variation(self, max_depth=None):
+        # follows the best scored child from the root
+        pv = []
+        node = self.root
+        while node.children and (max_depth is None or len(pv) < max_depth):
+            node = max(node.children.values(), key=self.score)
+            if node.n == 0:
+                break
+            pv.append(node.last_move)
+        return pv
 
     def get_move_winrate(self, move):
         child = self.root.children.get(move, None)
@@ -82,6 +177,9 @@ class MonteCarloTreeSearchMnkGame(MonteCarloTreeSearchMixin, MnkGameBotBase):
         if node.board.check_endgame() == 0:
             next_states = node.next_states()
             next_states = [state for state in next_states if state.n == 0]
+            if node is self.root and self.root_moves is not None:
+                next_states = [state for state in next_states
+                    if state.last_move in self.root_moves]
             old_states = []
             for state in next_states:
                 if state.last_move not in node.children:
@@ -96,13 +194,9 @@ class MonteCarloTreeSearchMnkGame(MonteCarloTreeSearchMixin, MnkGameBotBase):
         self.total_rollout += 1
         return node.rollout()
 
-    def backpropagation(self, node, winner):
-        if winner == node.turn:
-            reward = 1
-        elif winner == 0:  # a draw
-            reward = 0.5
-        else:
-            reward = 0
+    def backpropagation(self, node, value):
+        # value is the rollout result for player 1
+        reward = value if node.turn == 1 else 1-value
         while node != self.root:
             node.n += 1
             node.r += reward
@@ -114,13 +208,45 @@ class MonteCarloTreeSearchMnkGame(MonteCarloTreeSearchMixin, MnkGameBotBase):
 
 
 def run(seed, tree: MonteCarloTreeSearchMnkGame, board: MnkBoard, turn: int,
-        start_time: float):
+        start_time: float, queue=None, stop=None, index=0, callback_interval=0.1,
+        callback_rollouts=None):
     random.seed(seed)
     np.random.seed(seed)
-    tree.solve(board, turn, start_time)
+    callback = None
+    if queue is not None:
+        # reports root statistics back to the main process
+        def callback(snapshot):
+            queue.put((index, snapshot.rollout_count, snapshot.total_rollout,
+                tree.root_stats(), snapshot.pv))
+            return stop.is_set()
+    tree.solve(board, turn, start_time, callback, callback_interval,
+        callback_rollouts)
     return tree
 
 
+def combine_reports(reports, elapsed, top_k=5):
+    # builds a Snapshot from the latest (rollout_count, total_rollout,
+    # root_stats, pv) reported by each worker, without merging their trees
+    rollout_count = total_rollout = 0
+    stats = {}
+    for count, total, worker_stats, _ in reports:
+        rollout_count += count
+        total_rollout += total
+        for move, (n, r) in worker_stats.items():
+            old_n, old_r = stats.get(move, (0, 0.0))
+            stats[move] = (old_n+n, old_r+r)
+    snapshot = make_snapshot(stats, [], rollout_count, total_rollout, elapsed,
+        top_k)
+    if snapshot.top_moves:
+        # continues the pv of the worker which visited the best move the most
+        best_move = snapshot.top_moves[0][0]
+        pvs = [(worker_stats[best_move][0], pv)
+               for _, _, worker_stats, pv in reports if pv and pv[0] == best_move]
+        pv = max(pvs)[1] if pvs else [best_move]
+        snapshot = snapshot._replace(pv=pv)
+    return snapshot
+
+
 def merge_trees(trees):
     for i in range(len(trees)-1):
         tree1 = trees[i]
@@ -148,22 +274,64 @@ def merge_nodes(node1, node2, merge_children=True):
 
 
 def mcts_mnk_multi_proc(max_thinking_time, max_rollout, processes, policy,
-        exploration_const, board, turn, last_moves, inherit_last_tree=True):
+        exploration_const, board, turn, last_moves, inherit_last_tree=True,
+        callback=None, callback_interval=0.1, callback_rollouts=None,
+        evaluator=None, rollout_depth=0, root_moves=None, start_time=None):
     global last_tree
-    start = time.time()
+    start = start_time if start_time else time.time()
     args = []
+    root = None
+    if inherit_last_tree and last_tree is not None and len(last_moves) == 2:
+        root = last_tree.inherit(last_moves)
     for i in range(processes):
         tree = MonteCarloTreeSearchMnkGame(max_thinking_time,
-            max_rollout//processes, policy, exploration_const)
-        if inherit_last_tree and last_tree is not None and len(last_moves) == 2:
-            root = last_tree.inherit(last_moves)
-            if root is not None:
-                tree.root = root
-                tree.total_rollout = root.n
+            max_rollout//processes, policy, exploration_const, evaluator,
+            rollout_depth, root_moves)
+        if root is not None and i == 0:
+            # only one worker inherits, merge_trees would otherwise count the
+            # inherited statistics once per process
+            tree.root = root
+            tree.total_rollout = root.n
         random_seed = random.randint(0, 1<<32)
         args.append((random_seed, tree, board.duplicate(), turn, start))
-    pool = multiprocessing.Pool(processes)
-    trees = pool.starmap(run, args)
+    with multiprocessing.Pool(processes) as pool:
+        if callback is None:
+            trees = pool.starmap(run, args)
+        else:
+            manager = multiprocessing.Manager()
+            queue, stop = manager.Queue(), manager.Event()
+            worker_rollouts = None
+            if callback_rollouts is not None:
+                worker_rollouts = max(1, callback_rollouts // processes)
+            args = [arg + (queue, stop, i, callback_interval, worker_rollouts)
+                    for i, arg in enumerate(args)]
+            async_trees = pool.starmap_async(run, args)
+            progress = {}
+            last_time, last_count = start, 0
+            while not async_trees.ready() and not stop.is_set():
+                try:
+                    index, *report = queue.get(timeout=0.1)
+                except Empty:
+                    continue
+                progress[index] = report
+                if len(progress) < processes:
+                    continue  # snapshots cover every worker
+                rollout_count = sum(report[0] for report in progress.values())
+                if (callback_interval is not None and
+                        time.time()-last_time >= callback_interval) or \
+                        (callback_rollouts is not None and
+                        rollout_count-last_count >= callback_rollouts):
+                    last_time, last_count = time.time(), rollout_count
+                    if callback(combine_reports(progress.values(),
+                            time.time()-start)):
+                        stop.set()
+            trees = async_trees.get()
+            if not stop.is_set():
+                # end of search snapshot, like the single process search
+                callback(combine_reports([(tree.rollout_count, tree.total_rollout,
+                    tree.root_stats(), tree.principal_variation())
+                    for tree in trees], time.time()-start))
+            manager.shutdown()
     trees = [tree for tree in trees if tree.total_rollout > 0]
     if not trees:
         return -1, -1
@@ -181,17 +349,19 @@ def mcts_mnk_multi_proc(max_thinking_time, max_rollout, processes, policy,
 
 
 def mcts_mnk_single_process(max_thinking_time, max_rollout, policy,
-        exploration_const, board, turn, last_moves, inherit_last_tree=True):
+        exploration_const, board, turn, last_moves, inherit_last_tree=True,
+        callback=None, callback_interval=0.1, callback_rollouts=None,
+        evaluator=None, rollout_depth=0, root_moves=None, start_time=None):
     global last_tree
-    start = time.time()
+    start = start_time if start_time else time.time()
     tree = MonteCarloTreeSearchMnkGame(max_thinking_time, max_rollout,
-            policy, exploration_const)
+            policy, exploration_const, evaluator, rollout_depth, root_moves)
     if inherit_last_tree and last_tree is not None and len(last_moves) == 2:
         root = last_tree.inherit(last_moves)
         if root is not None:
             tree.root = root
             tree.total_rollout = root.n
-    tree.solve(board, turn)
+    tree.solve(board, turn, start, callback, callback_interval, callback_rollouts)
     last_tree = tree
     res = tree.get_results()
     last = time.time() - start
@@ -199,13 +369,95 @@ def mcts_mnk_single_process(max_thinking_time, max_rollout, policy,
     return res, tree
 
 
+def threat_space_search(board: MnkBoard, turn: int, threat_depth: int,
+        threat_nodes: int, deadline: float, stop=None):
+    # turn is to move. Returns (move, None) if turn has a forced win,
+    # (None, defending moves) if the opponent has one and (None, None) otherwise.
+    # All searches share threat_nodes nodes and stop at the deadline or once
+    # the stop event is set
+    if len(threat_cache) > THREAT_CACHE_SIZE:
+        threat_cache.clear()
+    start = time.time()
+
+    def stopped():
+        return stop is not None and stop.is_set()
+
+    move, nodes = board.threat_search(turn, threat_depth, threat_nodes,
+        cache=threat_cache, deadline=deadline)
+    if move is not None:
+        print("Threat-space search: forced win starting at", move,
+            "(%i nodes, %.2fs)" % (nodes, time.time()-start))
+        return move, None
+    if stopped():
+        return None, None
+    threat, used = board.threat_search(3-turn, threat_depth, threat_nodes-nodes,
+        cache=threat_cache, deadline=deadline)
+    nodes += used
+    if threat is None:
+        return None, None
+    defences = []
+    candidates = board.threat_defences(3-turn, threat)
+    for i, pos in enumerate(candidates):
+        if nodes >= threat_nodes or time.time() > deadline or stopped():
+            # out of budget, moves not checked yet may defend as well
+            defences.extend(candidates[i:])
+            break
+        new_board = board.duplicate()
+        new_board.put(turn, pos, False)
+        refutation, used = new_board.threat_search(3-turn, threat_depth,
+            threat_nodes-nodes, cache=threat_cache, deadline=deadline)
+        nodes += used
+        if refutation is None:
+            defences.append(pos)
+    print("Threat-space search: opponent threatens a forced win starting at",
+        threat, "- defending moves:", defences,
+        "(%i nodes, %.2fs)" % (nodes, time.time()-start))
+    # lost anyway if nothing defends, lets MCTS pick from every move
+    return None, defences if defences else None
+
+
 def mcts_solve(max_thinking_time, max_rollout, processes, policy,
-        exploration_const, inherit_last_tree, board, turn, last_moves):
+        exploration_const, inherit_last_tree, board, turn, last_moves,
+        callback=None, callback_interval=0.1, callback_rollouts=None,
+        evaluator=None, rollout_depth=0,
+        threat_depth=0, threat_nodes=2000, stop=None):
+    # callback(snapshot) receives a Snapshot of the (combined) search every
+    # callback_interval seconds or callback_rollouts rollouts, returning True
+    # stops the search. stop is an optional threading.Event which stops the
+    # threat-space search, which sends no snapshots.
+    # evaluator is the path of a pattern table from train_evaluator.py, with it
+    # rollouts are cut off after rollout_depth plies and scored by the table
+    # with threat_depth > 0, a threat-space search of up to threat_depth
+    # threats and threat_nodes nodes in total runs first for both sides. It
+    # takes at most half of max_thinking_time, MCTS gets the rest
+    global last_tree
+    start = time.time()
+    if isinstance(evaluator, str):
+        evaluator = load_evaluator(evaluator)
+    if evaluator is not None and evaluator.k != board.k:
+        raise Exception("Pattern table is made for k = %i, board has k = %i!" %
+            (evaluator.k, board.k))
     if processes < 1:
         raise Exception("Invalid number of processes: {processes}!")
-    elif processes > 1:
+    root_moves = None
+    if threat_depth > 0:
+        move, root_moves = threat_space_search(board, 3-turn, threat_depth,
+            threat_nodes, start + max_thinking_time/2, stop)
+        if move is not None:
+            # the previous tree doesn't lead to the next position anymore
+            last_tree = None
+            if callback is not None:
+                # no rollouts were played, the forced win is the whole analysis
+                callback(Snapshot(0, 0, time.time()-start, 0.0, [(move, 0, 1.0)],
+                    [move]))
+            return move, None
+    if processes > 1:
         return mcts_mnk_multi_proc(max_thinking_time, max_rollout, processes,
-            policy, exploration_const, board, turn, last_moves, inherit_last_tree)
+            policy, exploration_const, board, turn, last_moves, inherit_last_tree,
+            callback, callback_interval, callback_rollouts, evaluator, rollout_depth,
+            root_moves, start)
     else:
         return mcts_mnk_single_process(max_thinking_time, max_rollout, policy,
-            exploration_const, board, turn, last_moves, inherit_last_tree)
+            exploration_const, board, turn, last_moves, inherit_last_tree,
+            callback, callback_interval, callback_rollouts, evaluator, rollout_depth,
+            root_moves, start)
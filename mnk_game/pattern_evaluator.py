@@ -0,0 +1,74 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+class PatternEvaluator:
+    # Static evaluator over every k-cell line (horizontal, vertical and both
+    # diagonals) of the board. Each line is encoded in base 3 (0 empty, 1 and 2
+    # player symbols) and looked up in a table of 3^k weights per side to move.
+    # The sum of the weights is the logit of player 1 winning.
+
+    def __init__(self, k: int, table=None) -> None:
+        self.k = k
+        self.size = 3 ** k
+        if table is None:
+            table = np.zeros((2, self.size), dtype=np.float32)
+        assert table.shape == (2, self.size), \
+            "Table shape must be (2, %i), got %s" % (self.size, table.shape)
+        self.table = table.astype(np.float32)
+        # float32 as numpy has no fast matrix product of integers, exact
+        # up to 3^15 patterns
+        self.powers = (3 ** np.arange(k)).astype(np.float32)
+        self.windows = {}  # MnkBoard.line_windows() by board size
+
+    @classmethod
+    def load(cls, path: str):
+        table = np.load(path)
+        k = int(round(np.log(table.shape[1]) / np.log(3)))
+        return cls(k, table)
+
+    def save(self, path: str):
+        np.save(path, self.table)
+
+    def pattern_indices(self, board):
+        # reads the lines straight from the bitboards, with the cells of each
+        # line gathered by bit index
+        size = (board.m, board.n)
+        if size not in self.windows:
+            self.windows[size] = board.line_windows()
+        lines = board.cells()[self.windows[size]].astype(np.float32)
+        return (lines @ self.powers).astype(np.intp)
+
+    def features(self, board):
+        return np.bincount(self.pattern_indices(board), minlength=self.size)
+
+    def evaluate(self, board, turn: int) -> float:
+        # probability of player 1 winning with turn to move
+        logit = self.table[turn-1].take(self.pattern_indices(board)).sum()
+        return float(1 / (1 + np.exp(-logit)))
+
+    def fit(self, boards, turns, values, epochs=500, lr=1.0, l2=1e-4):
+        # logistic regression of game results (1 player 1 won, 0 player 2
+        # won, 0.5 draw) on pattern counts, separately for each side to move
+        features = np.stack([self.features(board) for board in boards]).astype(np.float64)
+        turns = np.asarray(turns)
+        values = np.asarray(values, dtype=np.float64)
+        for turn in (1, 2):
+            mask = turns == turn
+            if not mask.any():
+                continue
+            x, y = features[mask], values[mask]
+            # 1/L step size, L bounds the curvature of the mean logistic loss
+            step = lr / (0.25 * np.mean(np.sum(x ** 2, axis=1)) + l2)
+            w = np.zeros(self.size)
+            for _ in range(epochs):
+                p = 1 / (1 + np.exp(-(x @ w)))
+                w -= step * (x.T @ (p - y) / len(y) + l2 * w)
+            self.table[turn-1] = w
+        return self
+
+
+@lru_cache(maxsize=None)
+def load_evaluator(path: str) -> PatternEvaluator:
+    return PatternEvaluator.load(path)
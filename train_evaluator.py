@@ -0,0 +1,129 @@
+import argparse
+import random
+import sys
+
+import numpy as np
+import yaml
+
+from mnk_game.board import MnkBoard
+from mnk_game.mcts_mnkgame import mcts_solve
+from mnk_game.pattern_evaluator import PatternEvaluator
+
+
+def play_game(m, n, k, configs, random_plies=0):
+    # configs[turn-1] is the bot config of player turn
+    # returns boards before each move, players to move and the winner
+    board = MnkBoard(m, n, k)
+    boards, turns, moves = [], [], []
+    turn, res = 1, 0
+    while res == 0 and len(moves) < m * n:
+        boards.append(board.duplicate())
+        turns.append(turn)
+        if len(moves) < random_plies:
+            move = random.choice(board.get_possible_pos())
+        else:
+            move, _ = mcts_solve(
+                **configs[turn-1], board=board, turn=3-turn, last_moves=moves[-2:]
+            )
+        board.put(turn, move, False)
+        moves.append(move)
+        res = board.check_endgame()
+        turn = 3 - turn
+    return boards, turns, res
+
+
+def train(cfg, opt):
+    m, n, k = cfg["board_game"]["m"], cfg["board_game"]["n"], cfg["board_game"]["k"]
+    bot_cfg = dict(cfg["bot"]["config"], max_thinking_time=opt.time,
+        inherit_last_tree=False, evaluator=None)
+    positions, turns, values = [], [], []
+    for game in range(opt.games):
+        boards, game_turns, res = play_game(m, n, k, (bot_cfg, bot_cfg),
+            opt.random_plies)
+        print("Game %i/%i: %s" % (game+1, opt.games,
+            "draw" if res == 0 else "player %i won" % res))
+        value = 1.0 if res == 1 else (0.0 if res == 2 else 0.5)
+        for board, turn in zip(boards, game_turns):
+            # every symmetry of a position has the same value
+            for t in range(board.num_symmetries()):
+                positions.append(board.transform(t))
+                turns.append(turn)
+                values.append(value)
+    evaluator = PatternEvaluator(k).fit(positions, turns, values, opt.epochs)
+    predictions = np.array([evaluator.evaluate(board, turn)
+                            for board, turn in zip(positions, turns)])
+    print("Trained on %i positions, mean squared error: %.4f" %
+        (len(values), np.mean((predictions - np.array(values)) ** 2)))
+    evaluator.save(opt.out)
+    print("Saved pattern table to %s" % opt.out)
+
+
+def benchmark(cfg, opt):
+    # evaluator bot against full rollouts bot with the same thinking time
+    m, n, k = cfg["board_game"]["m"], cfg["board_game"]["n"], cfg["board_game"]["k"]
+    full_cfg = dict(cfg["bot"]["config"], max_thinking_time=opt.time,
+        inherit_last_tree=False, evaluator=None)
+    eval_cfg = dict(full_cfg, evaluator=opt.out, rollout_depth=opt.rollout_depth)
+    wins = draws = losses = 0
+    for game in range(opt.benchmark):
+        eval_turn = 1 if game % 2 == 0 else 2
+        configs = (eval_cfg, full_cfg) if eval_turn == 1 else (full_cfg, eval_cfg)
+        _, _, res = play_game(m, n, k, configs, opt.random_plies)
+        if res == 0:
+            draws += 1
+        elif res == eval_turn:
+            wins += 1
+        else:
+            losses += 1
+        print("Game %i/%i: evaluator bot %i wins, %i draws, %i losses" %
+            (game+1, opt.benchmark, wins, draws, losses))
+    print("Evaluator bot score: %.2f%%" %
+        ((wins + draws / 2) / opt.benchmark * 100))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg',
+                        type=str,
+                        default='configs/gomoku11x11.yaml',
+                        help='path to config file')
+    parser.add_argument('--out',
+                        type=str,
+                        default='pattern_table.npy',
+                        help='path to save (or load when benchmarking) the pattern table')
+    parser.add_argument('--games',
+                        type=int,
+                        default=100,
+                        help='number of self-play games for training')
+    parser.add_argument('--time',
+                        type=float,
+                        default=1.0,
+                        help='thinking time per move in seconds')
+    parser.add_argument('--random-plies',
+                        type=int,
+                        default=2,
+                        help='number of random opening moves per game')
+    parser.add_argument('--epochs',
+                        type=int,
+                        default=500,
+                        help='number of training epochs')
+    parser.add_argument('--benchmark',
+                        type=int,
+                        default=0,
+                        help='plays this many games of the trained table against '
+                             'full rollouts instead of training')
+    parser.add_argument('--rollout-depth',
+                        type=int,
+                        default=10,
+                        help='rollout cut off in plies when benchmarking')
+    opt = parser.parse_args()
+    with open(opt.cfg, "r") as stream:
+        try:
+            cfg = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            print(exc)
+            sys.exit()
+    if opt.benchmark > 0:
+        benchmark(cfg, opt)
+    else:
+        train(cfg, opt)